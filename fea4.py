@@ -1,14 +1,29 @@
 import os
+import re
+import sys
+import hashlib
+import json
+import collections
+import logging
+import argparse
+import cProfile
+import contextlib
+import tracemalloc
 import bpy
 import bmesh
-import pprint
 import math
+import mmap
+import time
 import mathutils
+import shutil
 import subprocess
+from mathutils.bvhtree import BVHTree
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 class FiniteElementMesher:
 
-    def __init__(self):
+    def __init__(self, base_path = 'C:/Users/dmou8237/Desktop/featest/', tetgen_path = 'C:/Users/dmou8237/Desktop/featest/tetgen.exe'):
         self.youngs_modulus = 13990000000.0
         self.poissons_ratio = 0.29
         self.density = 2397.0
@@ -17,10 +32,57 @@ class FiniteElementMesher:
         self.stick_slope = self.youngs_modulus / 10 # Arbitrary nonsense?
         self.gravity = 9.81
 
+        # Analysis step written at the end of the deck, picked per run by step_type.
+        # 'static' is a quick self-weight stability check that solves in a fraction
+        # of the time of the nonlinear 'dynamic' step. Templates are formatted with
+        # the material and load attributes, e.g. {gravity}.
+        self.step_type = 'dynamic'
+        self.step_templates = {
+            'dynamic': (
+                '\n*STEP,NLGEOM\n'
+                '*DYNAMIC\n'
+                '0.01,0.5\n'
+                '*DLOAD\n'
+                'Eall,GRAV, {gravity} ,0.,0.,-1.\n'
+                '*NODE FILE\n'
+                'U\n'
+                '*EL FILE\n'
+                'S\n'
+                '*END STEP\n'
+                ),
+            'static': (
+                '\n*STEP\n'
+                '*STATIC\n'
+                '1.,1.\n'
+                '*DLOAD\n'
+                'Eall,GRAV, {gravity} ,0.,0.,-1.\n'
+                '*NODE FILE\n'
+                'U\n'
+                '*EL FILE\n'
+                'S\n'
+                '*END STEP\n'
+                )
+            }
+
         self.node_index = 1
         self.element_index = 1
         self.object_node_offset = 0
 
+        # Per-iteration diagnostics are logged at DEBUG, stage summaries at INFO
+        self.logger = logging.getLogger('fea')
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.StreamHandler())
+            self.logger.setLevel(logging.INFO)
+        self.stage_timings = []
+        self.trace_memory = False
+        self.peak_traced_memory = None
+
+        # Carry vertex group membership onto tetgen node ids via a .smesh that
+        # keeps Blender's vertex order, instead of comparing rounded coordinates
+        self.use_vertex_index_mapping = True
+        self.node_rounding = 2
+        self.vertex_tolerance = 10 ** -self.node_rounding
+
         self.surfaces = {
             'S1': [1, 2, 3],
             'S2': [1, 4, 2],
@@ -28,130 +90,707 @@ class FiniteElementMesher:
             'S4': [3, 4, 1]
             }
 
-        self.base_path = 'C:/Users/dmou8237/Desktop/featest/'
-        self.tetgen_path = 'C:/Users/dmou8237/Desktop/featest/tetgen.exe'
-        self.stl_path = self.base_path + 'fea.stl'
-        self.node_path = self.base_path + 'fea.1.node'
-        self.element_path = self.base_path + 'fea.1.ele'
+        # Per element type: the tetgen flags, the column order taking tetgen's .ele
+        # rows to CalculiX connectivity, and the order that swaps corners 2 and 3
+        # (and their midside nodes) to restore positive volume for instances
+        # placed with a mirroring matrix_world. Both types share the S1-S4 faces.
+        # C3D4 is a much smaller and faster, but stiffer, first-pass model.
+        self.element_types = {
+            'C3D10': {
+                'tetgen_flags': ['-o2'],
+                'node_order': [1, 2, 3, 4, 7, 8, 10, 6, 9, 5],
+                'mirrored_node_order': [0, 2, 1, 3, 6, 5, 4, 7, 9, 8]
+                },
+            'C3D4': {
+                'tetgen_flags': [],
+                'node_order': [1, 2, 3, 4],
+                'mirrored_node_order': [0, 2, 1, 3]
+                }
+            }
+
+        # Reverse Cuthill-McKee renumbering of each object's nodes, which keeps
+        # the stiffness matrix bandwidth down for CalculiX's solvers
+        self.use_node_renumbering = True
+
+        # Write an ELSET of the boundary elements of every object
+        self.write_boundary_sets = False
+
+        self.base_path = base_path
+        self.tetgen_path = tetgen_path
+        # Each object is exported to and tetrahedralized in its own directory
+        # under scratch_path, so several tetgen processes can run at once
+        self.scratch_path = self.base_path + 'objects/'
+        self.tetgen_workers = os.cpu_count() or 1
+        # Element order flags are added by set_element_type
+        self.tetgen_flags = ['-p', '-g', '-F']
+        # Set to None to always re-run tetgen
+        self.tetgen_cache = TetgenCache(self.base_path + 'cache/', 2 * 1024 ** 3)
+        # Node renumbering orders by mesh hash and element node order, so
+        # unchanged shapes skip the slowest stage on later runs
+        self.renumbering_cache = TetgenCache(self.base_path + 'cache/rcm/', 256 * 1024 ** 2)
+        self.tetgen_chunk_size = 1 << 24
         self.inp_path = self.base_path + 'fea.inp'
+        self.report_path = self.base_path + 'fea_report.json'
+        # Set to a file name to dump cProfile stats of the whole run
+        self.profile_path = None
+        # Sections longer than this are split into *INCLUDE files written in parallel
+        self.inp_include_rows = 1000000
+        self.inp_buffer_size = 1 << 20
+        self.node_row_format = '%d, %r, %r, %r\n'
+
+        # Incremental mode gives every object its own node/element id range and
+        # *INCLUDE fragments under deck_path, and on the next run rewrites only
+        # the fragments of objects whose mesh or range changed. Unchanged
+        # objects are still loaded, from tetgen_cache rather than re-meshed,
+        # and renumbered with their order from renumbering_cache.
+        self.use_incremental_deck = False
+        self.deck_path = self.base_path + 'deck/'
+        self.deck_manifest_path = self.deck_path + 'manifest.json'
+        self.deck_range_headroom = 0.25
+
+        # Spill mode writes each object's *NODE and *ELEMENT rows to files under
+        # spill_path as soon as it is numbered, keeping only its exterior surface
+        # for contact and boundary sets, so memory follows the largest object
+        # rather than the assembly. Incremental decks have their own fragments.
+        self.use_spill_files = False
+        self.spill_path = self.base_path + 'spill/'
         self.bash_path = 'C:/cygwin64/bin/bash'
         self.reformat_path = self.base_path + 'reformat.sh'
         os.chdir(self.base_path)
 
-        open(self.inp_path, 'w').close()
-        self.inp_file = open(self.inp_path, 'a')
+        # Node ids of every object's Blender vertices, saved with each deck so
+        # import_results can play CalculiX displacements back onto the objects
+        self.node_map_path = self.base_path + 'fea_nodes.npz'
+        # 'shape_keys' adds one animated shape key per increment; 'attributes'
+        # stores each increment's displacement as a point attribute named after
+        # its frame, which is not animated by itself (Blender 2.91+)
+        self.results_mode = 'shape_keys'
+        self.results_start_frame = 1
+        self.results_frame_step = 1
+        self.displacement_scale = 1.0
 
-        self.nodes = []
-        self.elements = []
+        self.node_ids = np.empty(0, dtype=np.int32)
+        self.nodes = np.empty((0, 3), dtype=np.float64)
+        self.element_ids = np.empty(0, dtype=np.int32)
+        self.set_element_type('C3D10')
         self.slaves = []
         self.masters = []
 
+        # 'vertex_groups' pairs every tagged face of master objects against every
+        # tagged face of the rest; 'automatic' finds touching exterior faces of
+        # each pair of objects and gives every pair its own *CONTACT PAIR
+        self.contact_detection = 'vertex_groups'
+        # Name of the vertex group marking contact surfaces; None takes any group
+        self.contact_vertex_group = None
+        self.contact_gap = self.vertex_tolerance
+        self.contact_alignment = 0.95
+        self.contact_pairs = []
+
+        # Node sets are selected from a per-axis sorted index of self.nodes, built
+        # on first use, so each plane or box costs a binary search plus its matches
+        self.node_axis_index = None
+        self.ground_height = 0.0
+        self.ground_tolerance = 1e-6
+
+    def set_element_type(self, element_type):
+        settings = self.element_types[element_type]
+        self.element_type = element_type
+        self.element_tetgen_flags = settings['tetgen_flags']
+        self.element_node_order = settings['node_order']
+        self.mirrored_node_order = settings['mirrored_node_order']
+        self.element_row_format = ', '.join(['%d'] * (len(self.element_node_order) + 1)) + '\n'
+        self.elements = np.empty((0, len(self.element_node_order)), dtype=np.int32)
+
     def execute(self):
-        fea_objects = []
+        profiler = cProfile.Profile() if self.profile_path else None
+        if self.trace_memory:
+            tracemalloc.start()
+        started = (time.perf_counter(), time.process_time())
+        if profiler:
+            profiler.enable()
+        try:
+            self.build_deck()
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path)
+            self.stage_timings.append(self.get_timing('execute', None, started))
+            if self.trace_memory:
+                self.peak_traced_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.log_stage_totals()
+            if self.report_path:
+                self.write_run_report()
 
-        objects = bpy.data.objects
-        for object in objects:
-            self.triangulate(object)
-            self.save_ascii_stl(object)
-            self.generate_delaunay_tetrahedralization()
-            fea_objects.append({
+    def build_deck(self):
+        # Opened here rather than in __init__, so importing results keeps the deck
+        self.inp_file = open(self.inp_path, 'w', buffering=self.inp_buffer_size)
+        if self.use_spill_files:
+            if self.use_incremental_deck:
+                raise ValueError('use_spill_files and use_incremental_deck cannot be combined')
+            os.makedirs(self.spill_path, exist_ok=True)
+            self.ground_nodes = []
+        fea_objects = []
+        # Objects are meshed in local coordinates, so congruent blocks that only
+        # differ by matrix_world share one tetrahedralization
+        shapes = {}
+        for index, object in enumerate(bpy.data.objects):
+            fea_object = {
                 'object': object,
-                'is_master': object['master'] == 1,
-                'nodes': self.get_nodes(),
-                'elements': self.get_elements()
-                })
-            object.select = False
+                'name': object.name,
+                'index': index,
+                'is_master': object.get('master') == 1,
+                'matrix_world': np.array(object.matrix_world, dtype=np.float64),
+                'tetgen_input': None,
+                'instance_of': None
+                }
+            fea_objects.append(fea_object)
+            with self.stage('hash', object):
+                fea_object['mesh_hash'] = self.get_mesh_hash(object)
+            if fea_object['mesh_hash'] in shapes:
+                fea_object['instance_of'] = shapes[fea_object['mesh_hash']]
+            else:
+                shapes[fea_object['mesh_hash']] = fea_object
+        last_users = {id(object['instance_of'] or object): object['index'] for object in fea_objects}
+
+        # tetgen runs in its own process, so a thread pool is enough to keep
+        # tetgen_workers of them going. Each shape is submitted, along with the
+        # parsing of its output, as soon as it is exported. Results are collected
+        # in object order, so numbering matches a serial run, and at most
+        # tetgen_workers runs are kept queued ahead of collection, so finished
+        # outputs do not pile up while Blender exports the remaining objects.
+        renumbered_outputs = {}
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.tetgen_workers) as executor:
+            for object in fea_objects:
+                if object['instance_of'] is None:
+                    self.submit_object(object, executor)
+                pending.append(object)
+                while sum('tetgen_future' in object for object in pending) > self.tetgen_workers:
+                    self.process_object(pending.popleft(), renumbered_outputs, last_users)
+            while pending:
+                self.process_object(pending.popleft(), renumbered_outputs, last_users)
+
+        instances = sum(object['instance_of'] is not None for object in fea_objects)
+        if instances:
+            self.logger.info('instanced {0} of {1} objects from {2} unique shapes'.format(instances, len(fea_objects), len(shapes)))
+
+        if self.use_incremental_deck:
+            self.allocate_deck_ranges(fea_objects)
+            for object in fea_objects:
+                self.number_object(object, renumbered_outputs)
+
+        self.save_node_map(fea_objects)
 
+        if self.tetgen_cache is not None:
+            self.logger.info('tetgen cache: {hits} hits, {misses} misses, {entries} entries, {bytes} bytes'.format(**self.tetgen_cache.get_stats()))
+        if self.renumbering_cache is not None and self.use_node_renumbering:
+            self.logger.info('renumbering cache: {hits} hits, {misses} misses, {entries} entries, {bytes} bytes'.format(**self.renumbering_cache.get_stats()))
+
+        node_row = len(self.node_ids)
+        element_row = len(self.element_ids)
         for object in fea_objects:
-            self.nodes.extend(object['nodes'])
-            self.elements.extend(object['elements'])
-            if object['is_master']:
-                print('MASTER DETECT');
-                self.masters.extend(self.get_tagged_surfaces(object))
-            else:
-                print('SLAVE DETECT');
-                self.slaves.extend(self.get_tagged_surfaces(object))
+            object['node_rows'] = slice(node_row, node_row + len(object['node_ids']))
+            object['element_rows'] = slice(element_row, element_row + len(object['element_ids']))
+            node_row = object['node_rows'].stop
+            element_row = object['element_rows'].stop
+        self.fea_objects = fea_objects
+
+        if not self.use_spill_files:
+            self.node_ids = np.concatenate([self.node_ids] + [object['node_ids'] for object in fea_objects])
+            self.nodes = np.concatenate([self.nodes] + [object['nodes'] for object in fea_objects])
+            self.element_ids = np.concatenate([self.element_ids] + [object['element_ids'] for object in fea_objects])
+            self.elements = np.concatenate([self.elements] + [object['elements'] for object in fea_objects])
+
+        if self.contact_detection == 'automatic':
+            with self.stage('contact'):
+                self.contact_pairs = self.detect_contact_pairs(fea_objects)
+        else:
+            for object in fea_objects:
+                with self.stage('contact', object['object']):
+                    if object['is_master']:
+                        self.logger.debug('MASTER DETECT')
+                        self.masters.extend(self.get_tagged_surfaces(object))
+                    else:
+                        self.logger.debug('SLAVE DETECT')
+                        self.slaves.extend(self.get_tagged_surfaces(object))
+            self.contact_pairs = [{'slave': 'Sslav', 'master': 'Smast', 'slave_faces': self.slaves, 'master_faces': self.masters}]
 
         self.convert_m_to_mm()
-        self.write_inp_heading()
-        self.write_inp_node()
-        self.write_inp_element()
-        self.write_inp_ground_boundary(self.detect_ground_nodes())
-        self.write_inp_material()
-        self.write_inp_contact_pair()
-        self.write_inp_step()
-        self.inp_file.close()
-
-    def triangulate(self, object):
-        bpy.context.scene.objects.active = object
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.quads_convert_to_tris()
-        bpy.ops.object.mode_set(mode='OBJECT')
-
-    def save_ascii_stl(self, object):
-        object.select = True
-        bpy.ops.export_mesh.stl(filepath=self.stl_path, axis_forward='Y', axis_up='Z', ascii=True)
-
-    def generate_delaunay_tetrahedralization(self):
-        #subprocess.call([self.tetgen_path, '-q', '-p', '-g', '-F', '-o2', self.stl_path])
-        subprocess.call([self.tetgen_path, '-p', '-g', '-F', '-o2', self.stl_path])
+        with self.stage('write_inp'):
+            self.write_inp_heading()
+            with self.stage('write_inp_node'):
+                self.write_inp_node()
+            with self.stage('write_inp_element'):
+                self.write_inp_element()
+            with self.stage('ground'):
+                ground_nodes = self.detect_ground_nodes()
+            self.write_inp_ground_boundary(ground_nodes)
+            if self.write_boundary_sets:
+                self.write_inp_boundary_sets()
+            self.write_inp_material()
+            with self.stage('write_inp_contact_pair'):
+                self.write_inp_contact_pair()
+            self.write_inp_step()
+            self.inp_file.close()
+
+        if self.use_incremental_deck:
+            self.save_deck_manifest(fea_objects)
+
+    def run_tetgen(self, object):
+        # Runs on a pool thread, so it must not touch bpy, not even object.name
+        self.generate_delaunay_tetrahedralization(object['tetgen_input'])
+        started = (time.perf_counter(), time.process_time())
+        try:
+            return self.read_tetgen_results(object)
+        finally:
+            self.stage_timings.append(self.get_timing('read_tetgen_output', object['name'], started))
+
+    def submit_object(self, object, executor):
+        # Cache hits are only looked up here, and loaded when collected
+        if self.tetgen_cache is not None and self.tetgen_cache.contains(object['mesh_hash']):
+            return
+        self.export_object(object)
+        object['tetgen_future'] = executor.submit(self.run_tetgen, object)
+
+    def export_object(self, object):
+        with self.stage('triangulate', object['object']):
+            vertices, triangles = self.get_surface_arrays(object['object'])
+        with self.stage('export', object['object']):
+            tetgen_base = self.get_scratch_directory(object['index'], object['object']) + 'fea'
+            if self.use_vertex_index_mapping:
+                tetgen_input = tetgen_base + '.smesh'
+                self.save_smesh(tetgen_input, vertices, triangles)
+            else:
+                tetgen_input = tetgen_base + '.stl'
+                self.save_ascii_stl(tetgen_input, vertices, triangles)
+        object['vertices'] = vertices
+        object['tetgen_input'] = tetgen_input
+        object['tetgen_base'] = tetgen_base
+
+    def collect_tetgen_output(self, object):
+        if object['instance_of'] is not None:
+            object['tetgen_output'] = object['instance_of']['tetgen_output']
+            return
+        if 'tetgen_future' not in object:
+            with self.stage('cache', object['object']):
+                object['tetgen_output'] = self.tetgen_cache.get(object['mesh_hash'])
+            if object['tetgen_output'] is not None:
+                return
+            # Evicted after submit_object found it, so mesh it here instead
+            self.export_object(object)
+            object['tetgen_output'] = self.run_tetgen(object)
+        else:
+            # Time the main thread spends blocked on the pool
+            with self.stage('tetgen_wait', object['object']):
+                object['tetgen_output'] = object.pop('tetgen_future').result()
+        del object['vertices']
+        if self.tetgen_cache is not None:
+            with self.stage('cache', object['object']):
+                self.tetgen_cache.put(object['mesh_hash'], object['tetgen_output'])
+
+    def process_object(self, object, renumbered_outputs, last_users):
+        self.collect_tetgen_output(object)
+        if not self.use_incremental_deck:
+            self.number_object(object, renumbered_outputs)
+        if self.use_spill_files:
+            with self.stage('spill', object['object']):
+                self.spill_object(object)
+            # Instances let go of the shared tetgen output straight away, the
+            # shape's own copy goes once its last instance is numbered
+            source = object['instance_of'] or object
+            if source is not object:
+                object['tetgen_output'] = None
+            if last_users[id(source)] == object['index']:
+                source['tetgen_output'] = None
+                renumbered_outputs.pop(source['mesh_hash'], None)
+
+    def number_object(self, object, renumbered_outputs):
+        if self.use_incremental_deck:
+            self.node_index = object['deck_record']['node_start']
+            self.element_index = object['deck_record']['element_start']
+            self.object_node_offset = self.node_index - 1
+        tetgen_output = object['tetgen_output']
+        if self.use_node_renumbering:
+            if object['mesh_hash'] not in renumbered_outputs:
+                with self.stage('renumber', object['object']):
+                    renumbered_outputs[object['mesh_hash']] = self.renumber_tetgen_output(object['name'], tetgen_output, object['mesh_hash'])
+            tetgen_output = renumbered_outputs[object['mesh_hash']]
+        with self.stage('number', object['object']):
+            object['node_ids'], object['nodes'] = self.get_nodes(tetgen_output['nodes'], object['matrix_world'])
+            object['element_ids'], object['elements'] = self.get_elements(
+                tetgen_output['elements'], np.linalg.det(object['matrix_world'][:3, :3]) < 0)
+            object['faces'] = tetgen_output.get('faces')
+            object['neighbours'] = tetgen_output.get('neighbours')
+            object['node_vertices'] = tetgen_output.get('node_vertices')
+            object['node_count'] = len(object['node_ids'])
+            object['element_count'] = len(object['element_ids'])
+        with self.stage('exterior_faces', object['object']):
+            object['exterior_faces'] = self.get_exterior_faces(object)
+
+    def spill_object(self, object):
+        object['node_spill'] = '{0}nodes_{1}.inp'.format(self.spill_path, object['node_ids'][0])
+        object['element_spill'] = '{0}elements_{1}.inp'.format(self.spill_path, object['element_ids'][0])
+        self.write_inp_include(object['node_spill'], self.node_row_format, np.column_stack([object['node_ids'], object['nodes']]))
+        self.write_inp_include(object['element_spill'], self.element_row_format, np.column_stack([object['element_ids'], object['elements']]))
+        self.ground_nodes.append(object['node_ids'][np.abs(object['nodes'][:, 2] - self.ground_height) <= self.ground_tolerance])
+
+        # Keep the elements with exterior faces, and the nodes at their corners or
+        # at Blender vertices. Ids stay sorted, so lookups by id still work.
+        rows, columns = object['exterior_faces']
+        elements = np.unique(rows)
+        object['exterior_faces'] = (np.searchsorted(elements, rows), columns)
+        object['element_ids'] = object['element_ids'][elements]
+        object['elements'] = object['elements'][elements]
+        nodes = np.zeros(len(object['node_ids']), dtype=bool)
+        nodes[np.searchsorted(object['node_ids'], self.get_surface_corners(object['elements']).ravel())] = True
+        if object['node_vertices'] is not None:
+            nodes |= object['node_vertices'] >= 0
+            object['node_vertices'] = object['node_vertices'][nodes]
+        object['node_ids'] = object['node_ids'][nodes]
+        object['nodes'] = object['nodes'][nodes]
+
+    def copy_spill_files(self, paths):
+        for path in paths:
+            with open(path) as file:
+                shutil.copyfileobj(file, self.inp_file, self.inp_buffer_size)
+            os.remove(path)
+
+    @contextlib.contextmanager
+    def stage(self, name, object = None):
+        started = (time.perf_counter(), time.process_time())
+        try:
+            yield
+        finally:
+            self.stage_timings.append(self.get_timing(name, object.name if object is not None else None, started))
+
+    def get_timing(self, name, object_name, started):
+        # process_time covers every thread of this process but not the CPU
+        # spent inside tetgen's own processes
+        return {
+            'stage': name,
+            'object': object_name,
+            'wall': time.perf_counter() - started[0],
+            'cpu': time.process_time() - started[1]
+            }
+
+    def get_stage_totals(self):
+        totals = {}
+        for timing in self.stage_timings:
+            total = totals.setdefault(timing['stage'], {'wall': 0.0, 'cpu': 0.0, 'count': 0})
+            total['wall'] = total['wall'] + timing['wall']
+            total['cpu'] = total['cpu'] + timing['cpu']
+            total['count'] = total['count'] + 1
+        return totals
+
+    def log_stage_totals(self):
+        for name, total in self.get_stage_totals().items():
+            self.logger.info('{0:<24} {1:9.3f}s wall {2:9.3f}s cpu  x{3}'.format(name, total['wall'], total['cpu'], total['count']))
+
+    def get_peak_rss(self):
+        # Peak resident set size in bytes, where the platform reports it
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def write_run_report(self):
+        objects = []
+        for object in getattr(self, 'fea_objects', []):
+            objects.append({
+                'name': object['object'].name,
+                'nodes': object.get('node_count', 0),
+                'elements': object.get('element_count', 0),
+                'instance_of': object['instance_of']['object'].name if object['instance_of'] is not None else None,
+                'tetgen': object['tetgen_input'] is not None
+                })
+        report = {
+            'nodes': sum(object['nodes'] for object in objects),
+            'elements': sum(object['elements'] for object in objects),
+            'objects': objects,
+            'stages': self.stage_timings,
+            'stage_totals': self.get_stage_totals(),
+            'peak_traced_memory': self.peak_traced_memory,
+            'peak_rss': self.get_peak_rss(),
+            'tetgen_cache': self.tetgen_cache.get_stats() if self.tetgen_cache is not None else None,
+            'renumbering_cache': self.renumbering_cache.get_stats() if self.renumbering_cache is not None else None
+            }
+        with open(self.report_path, 'w') as file:
+            json.dump(report, file, indent=1)
+
+    def triangulate(self, mesh):
+        # Triangles as vertex indices, from a bmesh copy triangulated in memory.
+        # The user's mesh is left as it is and no operators or mode switches are
+        # needed, so this also runs in background mode. bmesh.ops.triangulate
+        # only adds faces, so vertex indices still match mesh.vertices.
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+        bmesh.ops.triangulate(bm, faces=bm.faces[:])
+        triangulated = bpy.data.meshes.new(mesh.name + '_fea')
+        bm.to_mesh(triangulated)
+        bm.free()
+        _, loop_vertices, loop_starts, _ = self.get_mesh_arrays(triangulated)
+        bpy.data.meshes.remove(triangulated)
+        return loop_vertices[loop_starts[:, np.newaxis] + np.arange(3)]
+
+    def get_mesh_arrays(self, mesh):
+        vertices = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', vertices)
+        loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get('vertex_index', loop_vertices)
+        loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get('loop_start', loop_starts)
+        loop_totals = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get('loop_total', loop_totals)
+        return vertices, loop_vertices, loop_starts, loop_totals
+
+    def get_mesh_hash(self, object):
+        # Identifies the surface tetgen would see: local geometry and flags
+        digest = hashlib.sha256()
+        for values in self.get_mesh_arrays(object.data):
+            digest.update(values.tobytes())
+        digest.update(' '.join(self.tetgen_flags + self.element_tetgen_flags).encode())
+        digest.update(b'smesh' if self.use_vertex_index_mapping else b'stl')
+        return digest.hexdigest()
+
+    def get_surface_arrays(self, object):
+        # Local vertex coordinates, pulled from the mesh with foreach_get rather
+        # than per-vertex attribute access, and triangle vertex indices
+        vertices = np.empty(len(object.data.vertices) * 3, dtype=np.float32)
+        object.data.vertices.foreach_get('co', vertices)
+        return vertices.reshape(-1, 3).astype(np.float64), self.triangulate(object.data)
+
+    def format_table(self, row_format, table, chunk_rows = 1 << 16):
+        # Formats a whole block of rows with a single % operation per chunk
+        for start in range(0, len(table), chunk_rows):
+            chunk = table[start:start + chunk_rows]
+            yield (row_format * len(chunk)) % tuple(chunk.ravel().tolist())
+
+    def get_scratch_directory(self, index, object):
+        directory = self.scratch_path + '{0:04d}_{1}/'.format(index, re.sub(r'[^\w.-]', '_', object.name))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def save_ascii_stl(self, path, vertices, triangles):
+        # tetgen only reads ASCII STL
+        corners = vertices[triangles]
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        lengths = np.linalg.norm(normals, axis=1)
+        normals[lengths > 0] /= lengths[lengths > 0, np.newaxis]
+
+        facet_format = ('facet normal %r %r %r\n outer loop\n' + '  vertex %r %r %r\n' * 3 + ' endloop\nendfacet\n')
+        with open(path, 'w') as file:
+            file.write('solid fea\n')
+            file.writelines(self.format_table(facet_format, np.column_stack([normals, corners.reshape(-1, 9)])))
+            file.write('endsolid fea\n')
+
+    def save_smesh(self, path, vertices, triangles):
+        # Node n of the .smesh is Blender vertex n - 1, and tetgen keeps input
+        # points as its first nodes, so ids survive tetrahedralization
+        with open(path, 'w') as file:
+            file.write('{0} 3 0 0\n'.format(len(vertices)))
+            file.writelines(self.format_table('%d %r %r %r\n', np.column_stack([np.arange(1, len(vertices) + 1), vertices])))
+            file.write('{0} 0\n'.format(len(triangles)))
+            file.writelines(self.format_table('3 %d %d %d\n', triangles + 1))
+            file.write('0\n0\n')
+
+    def generate_delaunay_tetrahedralization(self, source):
+        started = (time.perf_counter(), time.process_time())
+        with open(os.path.splitext(source)[0] + '.log', 'w') as log:
+            # Adding '-q' to tetgen_flags gives better shaped tetrahedra
+            subprocess.check_call([self.tetgen_path] + self.tetgen_flags + self.element_tetgen_flags + [source], stdout=log)
+        # Timed per scratch directory, as the worker only sees the input path
+        self.stage_timings.append(self.get_timing('tetgen_process', os.path.basename(os.path.dirname(source)), started))
         # Potential discrepancies between our triangulation and theirs when -q argument used
+        # (with use_vertex_index_mapping the spatial hash in get_node_vertex_map covers Steiner points)
+
+    def read_tetgen_results(self, object):
+        tetgen_output = {
+            'nodes': self.read_tetgen_output(object['tetgen_base'] + '.1.node'),
+            'elements': self.read_tetgen_output(object['tetgen_base'] + '.1.ele', np.int32),
+            'faces': self.read_optional_tetgen_output(object['tetgen_base'] + '.1.face', np.int32),
+            'neighbours': self.read_optional_tetgen_output(object['tetgen_base'] + '.1.neigh', np.int32)
+            }
+        if self.use_vertex_index_mapping:
+            tetgen_output['node_vertices'] = self.get_node_vertex_map(object['vertices'], tetgen_output['nodes'][:, 1:4])
+        return {name: table for name, table in tetgen_output.items() if table is not None}
+
+    def renumber_tetgen_output(self, name, tetgen_output, mesh_hash = None):
+        node_count = len(tetgen_output['nodes'])
+        connectivity = tetgen_output['elements'][:, self.element_node_order] - 1
+        key = self.get_renumbering_key(mesh_hash)
+        order = self.get_cached_renumbering_order(key, node_count)
+        cached = order is not None
+        if not cached:
+            order = self.get_reverse_cuthill_mckee_order(connectivity, node_count)
+            if key is not None:
+                self.renumbering_cache.put(key, {'order': order})
+        new_indices = np.empty(node_count, dtype=np.int32)
+        new_indices[order] = np.arange(node_count, dtype=np.int32)
+
+        renumbered = dict(tetgen_output)
+        renumbered['nodes'] = tetgen_output['nodes'][order]
+        renumbered['nodes'][:, 0] = np.arange(1, node_count + 1)
+        renumbered['elements'] = tetgen_output['elements'].copy()
+        renumbered['elements'][:, self.element_node_order] = new_indices[connectivity] + 1
+        if 'faces' in tetgen_output:
+            renumbered['faces'] = tetgen_output['faces'].copy()
+            renumbered['faces'][:, 1:4] = new_indices[tetgen_output['faces'][:, 1:4] - 1] + 1
+        if 'node_vertices' in tetgen_output:
+            renumbered['node_vertices'] = tetgen_output['node_vertices'][order]
+
+        # Bandwidths were logged when the cached order was computed
+        if not cached:
+            self.logger.info('renumbered {0}: bandwidth {1} -> {3}, profile {2} -> {4}'.format(
+                name, *(self.get_bandwidth(connectivity, node_count) + self.get_bandwidth(new_indices[connectivity], node_count))))
+        return renumbered
+
+    def get_renumbering_key(self, mesh_hash):
+        # Orders depend on the shape and on which tetgen columns are corners
+        if self.renumbering_cache is None or mesh_hash is None:
+            return None
+        return mesh_hash + '_' + hashlib.sha1(repr(self.element_node_order).encode('utf-8')).hexdigest()[:8]
+
+    def get_cached_renumbering_order(self, key, node_count):
+        if key is None or not self.renumbering_cache.contains(key):
+            return None
+        entry = self.renumbering_cache.get(key)
+        if entry is None or len(entry['order']) != node_count:
+            return None
+        return entry['order']
+
+    def get_node_adjacency(self, connectivity, node_count):
+        # Compressed sparse rows of the node graph, each row sorted by degree
+        columns = connectivity.shape[1]
+        pairs = np.array([(i, j) for i in range(columns) for j in range(columns) if i != j])
+        edges = np.sort(connectivity[:, pairs[:, 0]].astype(np.int64).ravel() * node_count +
+                        connectivity[:, pairs[:, 1]].ravel())
+        edges = edges[np.concatenate([[True], edges[1:] != edges[:-1]])]
+        rows = edges // node_count
+        neighbours = edges % node_count
+        degrees = np.bincount(rows, minlength=node_count)
+        neighbours = neighbours[np.lexsort((degrees[neighbours], rows))]
+        offsets = np.concatenate([[0], np.cumsum(degrees)])
+        return offsets, neighbours, degrees
+
+    def get_reverse_cuthill_mckee_order(self, connectivity, node_count):
+        offsets, neighbours, degrees = self.get_node_adjacency(connectivity, node_count)
+        visited = np.zeros(node_count, dtype=bool)
+        levels = []
+
+        # One breadth first search per connected component, started from its
+        # lowest degree node and expanded a whole level at a time
+        for start in np.argsort(degrees, kind='stable').tolist():
+            if visited[start]:
+                continue
+            frontier = np.array([start])
+            visited[start] = True
+            while len(frontier):
+                levels.append(frontier)
+                counts = degrees[frontier]
+                positions = np.repeat(offsets[frontier] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                candidates = neighbours[positions]
+                candidates = candidates[~visited[candidates]]
+                _, first = np.unique(candidates, return_index=True)
+                frontier = candidates[np.sort(first)]
+                visited[frontier] = True
 
-    def get_nodes(self):
-        nodes = self.load_tetgen_output(self.node_path, 2)
-        for index, node in enumerate(nodes):
-            nodes[index][0] = self.node_index
-            self.node_index = self.node_index + 1
-        return nodes
-
-    def get_elements(self):
-        unsorted_elements = self.load_tetgen_output(self.element_path)
-        elements = []
-        for element in unsorted_elements:
-            elements.append([
-                self.element_index,
-                element[1] + self.object_node_offset,
-                element[2] + self.object_node_offset,
-                element[3] + self.object_node_offset,
-                element[4] + self.object_node_offset,
-                element[7] + self.object_node_offset,
-                element[8] + self.object_node_offset,
-                element[10] + self.object_node_offset,
-                element[6] + self.object_node_offset,
-                element[9] + self.object_node_offset,
-                element[5] + self.object_node_offset
-                ])
-            self.element_index = self.element_index + 1
+        return np.concatenate(levels)[::-1]
+
+    def get_bandwidth(self, connectivity, node_count):
+        # Returns the bandwidth and profile of the stiffness matrix pattern
+        lowest = connectivity.min(axis=1)
+        bandwidth = int((connectivity.max(axis=1) - lowest).max()) if len(connectivity) else 0
+        row_start = np.arange(node_count)
+        np.minimum.at(row_start, connectivity.ravel(), np.repeat(lowest, connectivity.shape[1]))
+        profile = int((np.arange(node_count) - row_start).sum())
+        return bandwidth, profile
+
+    def get_nodes(self, table, matrix_world):
+        nodes = np.round(table[:, 1:4].dot(matrix_world[:3, :3].T) + matrix_world[:3, 3], self.node_rounding)
+        node_ids = np.arange(self.node_index, self.node_index + len(nodes), dtype=np.int32)
+        self.node_index = self.node_index + len(nodes)
+        return node_ids, nodes
+
+    def get_elements(self, table, mirrored = False):
+        elements = table[:, self.element_node_order] + self.object_node_offset
+        if mirrored:
+            elements = elements[:, self.mirrored_node_order]
+        element_ids = np.arange(self.element_index, self.element_index + len(elements), dtype=np.int32)
+        self.element_index = self.element_index + len(elements)
         self.object_node_offset = self.node_index - 1
-        return elements
+        return element_ids, elements
+
+    def get_vertex_group_mask(self, object):
+        # Vertices in contact_vertex_group, or in any group when it is None.
+        # Membership has no foreach_get accessor, so vertex.groups is read in one
+        # generator pass straight into the mask, without per-vertex lists.
+        vertices = object.data.vertices
+        if self.contact_vertex_group is None:
+            memberships = (len(vertex.groups) > 0 for vertex in vertices)
+        elif self.contact_vertex_group not in object.vertex_groups:
+            # Objects without the group have no tagged vertices
+            return np.zeros(len(vertices), dtype=bool)
+        else:
+            group_index = object.vertex_groups[self.contact_vertex_group].index
+            memberships = (any(element.group == group_index for element in vertex.groups) for vertex in vertices)
+        return np.fromiter(memberships, dtype=bool, count=len(vertices))
 
     def get_vertices_in_vertex_group(self, object):
-        vertices = []
-        for vertex in object['object'].data.vertices:
-            if (len(vertex.groups)):
-                vertices.append(
-                    [round(vertex.co.x, 2), round(vertex.co.y, 2), round(vertex.co.z, 2)]
-                )
-        return vertices
+        vertices = self.get_mesh_arrays(object['object'].data)[0].reshape(-1, 3)
+        tagged = np.round(vertices[self.get_vertex_group_mask(object['object'])], 2)
+        return set(map(tuple, tagged.tolist()))
 
     def get_faces_in_vertex_group(self, object):
-        print('getting faces in vertex group')
-        faces = []
-        for polygon in object['object'].data.polygons:
-            vertex1 = object['object'].data.vertices[polygon.vertices[0]]
-            vertex2 = object['object'].data.vertices[polygon.vertices[1]]
-            vertex3 = object['object'].data.vertices[polygon.vertices[2]]
+        # Rounded corners of the polygons whose first three vertices are tagged
+        vertices, loop_vertices, loop_starts, _ = self.get_mesh_arrays(object['object'].data)
+        corners = loop_vertices[loop_starts[:, np.newaxis] + np.arange(3)]
+        corners = corners[self.get_vertex_group_mask(object['object'])[corners].all(axis=1)]
+        return np.round(vertices.reshape(-1, 3)[corners], 2).tolist()
 
-            if not (len(vertex1.groups) and len(vertex2.groups) and len(vertex3.groups)):
-                continue
+    def get_node_vertex_map(self, vertices, nodes):
+        # Returns the Blender vertex index for each node, or -1 for Steiner points
+        node_vertices = np.full(len(nodes), -1, dtype=np.int32)
+        if len(nodes) >= len(vertices) and np.all(np.abs(nodes[:len(vertices)] - vertices) <= self.vertex_tolerance):
+            node_vertices[:len(vertices)] = np.arange(len(vertices))
+            return node_vertices
 
-            pprint.pprint(polygon)
-            faces.append([
-                [round(vertex1.co.x, 2), round(vertex1.co.y, 2), round(vertex1.co.z, 2)],
-                [round(vertex2.co.x, 2), round(vertex2.co.y, 2), round(vertex2.co.z, 2)],
-                [round(vertex3.co.x, 2), round(vertex3.co.y, 2), round(vertex3.co.z, 2)]
-            ])
-        return faces
+        self.logger.info('tetgen reordered input points, falling back to spatial hash')
+        cells = {}
+        for index, vertex in enumerate(vertices):
+            cells.setdefault(self.get_cell(vertex), []).append(index)
+
+        for node_index, node in enumerate(nodes):
+            x, y, z = self.get_cell(node)
+            for cell in ((x + i, y + j, z + k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)):
+                for index in cells.get(cell, ()):
+                    if self.is_node_at_vertex(node, vertices[index]):
+                        node_vertices[node_index] = index
+                        break
+                if node_vertices[node_index] != -1:
+                    break
+        return node_vertices
+
+    def get_cell(self, co):
+        return (
+            math.floor(co[0] / self.vertex_tolerance),
+            math.floor(co[1] / self.vertex_tolerance),
+            math.floor(co[2] / self.vertex_tolerance)
+            )
+
+    def is_node_at_vertex(self, node, vertex):
+        return (abs(node[0] - vertex[0]) <= self.vertex_tolerance and
+                abs(node[1] - vertex[1]) <= self.vertex_tolerance and
+                abs(node[2] - vertex[2]) <= self.vertex_tolerance)
+
+    def get_tagged_nodes(self, object):
+        tagged_vertices = self.get_vertex_group_mask(object['object'])
+        node_vertices = object['node_vertices']
+        tagged_nodes = np.zeros(len(node_vertices), dtype=bool)
+        tagged_nodes[node_vertices >= 0] = tagged_vertices[node_vertices[node_vertices >= 0]]
+        return tagged_nodes
 
     def is_node_in_tri_old(self, node, tri1, tri2, tri3):
         check = mathutils.geometry.intersect_point_tri(
@@ -170,64 +809,204 @@ class FiniteElementMesher:
         return False
 
     def get_tagged_surfaces(self, object):
+        if object['node_vertices'] is not None:
+            return self.get_tagged_surfaces_by_index(object)
+
         faces = []
-        print('get tagged verts')
+        self.logger.debug('get tagged verts')
         tagged_vertices = self.get_vertices_in_vertex_group(object)
-        print(tagged_vertices)
-        print('finished getting tagged verts')
-        #original_faces = self.get_faces_in_vertex_group(object)
-
-        #for original_face in original_faces:
-        #    print('TESTING ' + str(original_face[0]) + ',' + str(original_face[1]) + ',' + str(original_face[2]))
-
-        for element in object['elements']:
-            # Test each combination of surfaces
-            for surface_name, surface_indices in self.surfaces.items():
-                node1_index = element[surface_indices[0]]
-                node2_index = element[surface_indices[1]]
-                node3_index = element[surface_indices[2]]
-
-                for node in object['nodes']:
-                    if node[0] == node1_index:
-                        node1 = [node[1], node[2], node[3]]
-                    elif node[0] == node2_index:
-                        node2 = [node[1], node[2], node[3]]
-                    elif node[0] == node3_index:
-                        node3 = [node[1], node[2], node[3]]
-
-                if node1 in tagged_vertices and node2 in tagged_vertices and node3 in tagged_vertices:
-                    print('WE GOT ONE')
-                    faces.append([element[0], surface_name])
-
-                """
-                for original_face in original_faces:
-                    check_node1 = self.is_node_in_tri(node1, original_face[0], original_face[1], original_face[2])
-                    check_node2 = self.is_node_in_tri(node2, original_face[0], original_face[1], original_face[2])
-                    check_node3 = self.is_node_in_tri(node3, original_face[0], original_face[1], original_face[2])
-                    #if check_node1:
-                        #print('RESULT FOR ' + str(surface_name) + ', WITH ' + str(node1) + ',' + str(original_face[0]) + ',' + str(original_face[1]) + ',' + str(original_face[2]) + ' IS ' + str(check_node1))
-
-                if node1_index == 40 and node2_index == 43 and node3_index == 34:
-                    print('HERE IT IS')
-                    print(node1_index, node2_index, node3_index)
-                    print(node1, node2, node3)
-                    print('a' == 'a')
-                    print(node3)
-                    print(original_face[2])
-                    print(node3 == original_face[2])
-                    print(check_node1, check_node2, check_node3)
-
-
-                if check_node1 and check_node2:
-                    print('NODECHECKA ' + str(node1) + ',' + str(node2) + ',' + str(node3))
-
-                if check_node1 and check_node2 and check_node3:
-                    print('WE GOT ONE')
-                    faces.append([element[0], surface_name])
-                """
+        self.logger.debug('%s', tagged_vertices)
+        self.logger.debug('finished getting tagged verts')
+        node_coordinates = dict(zip(object['node_ids'].tolist(), map(tuple, object['nodes'].tolist())))
+        surface_names = list(self.surfaces)
+        rows, columns = object['exterior_faces']
+
+        # Only faces on the object's boundary can touch another object
+        for element_id, element, column in zip(object['element_ids'][rows].tolist(), object['elements'][rows].tolist(), columns.tolist()):
+            surface_name = surface_names[column]
+            surface_indices = self.surfaces[surface_name]
+            node1 = node_coordinates[element[surface_indices[0] - 1]]
+            node2 = node_coordinates[element[surface_indices[1] - 1]]
+            node3 = node_coordinates[element[surface_indices[2] - 1]]
+
+            if node1 in tagged_vertices and node2 in tagged_vertices and node3 in tagged_vertices:
+                self.logger.debug('WE GOT ONE')
+                faces.append([element_id, surface_name])
 
         return faces
 
+    def get_tagged_surfaces_by_index(self, object):
+        tagged_nodes = self.get_tagged_nodes(object)
+        surface_names = list(self.surfaces)
+        rows, columns = object['exterior_faces']
+
+        # (faces, 3) corner positions within this object's node block
+        surface_nodes = np.searchsorted(object['node_ids'], self.get_surface_corners(object['elements'])[rows, columns])
+        tagged = tagged_nodes[surface_nodes].all(axis=1)
+        return [[element_id, surface_names[column]] for element_id, column in zip(object['element_ids'][rows[tagged]].tolist(), columns[tagged].tolist())]
+
+    def get_surface_corners(self, elements):
+        # (elements, surfaces, 3) corner node ids of every S1-S4 face
+        return elements[:, [[index - 1 for index in corners] for corners in self.surfaces.values()]]
+
+    def get_exterior_faces(self, object):
+        # A face shared by two tetrahedra is interior, so the boundary is the
+        # set of sorted corner triples that occur exactly once
+        faces = np.sort(self.get_surface_corners(object['elements']), axis=2).reshape(-1, 3)
+        order = np.lexsort(faces.T[::-1])
+        sorted_faces = faces[order]
+        repeated = np.all(sorted_faces[1:] == sorted_faces[:-1], axis=1)
+        single = ~(np.concatenate([[False], repeated]) | np.concatenate([repeated, [False]]))
+        exterior = np.sort(order[single])
+        return exterior // len(self.surfaces), exterior % len(self.surfaces)
+
+    def get_exterior_triangles(self, object):
+        # Corner positions of the exterior faces, indexed like exterior_faces
+        rows, columns = object['exterior_faces']
+        corners = np.searchsorted(object['node_ids'], self.get_surface_corners(object['elements'])[rows, columns])
+        return object['nodes'], corners
+
+    def save_node_map(self, fea_objects):
+        names, objects, vertices, nodes = [], [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=np.int32)]
+        for object in fea_objects:
+            if object['node_vertices'] is None:
+                continue
+            mapped = object['node_vertices'] >= 0
+            objects.append(np.full(np.count_nonzero(mapped), len(names), dtype=np.int32))
+            names.append(object['object'].name)
+            vertices.append(object['node_vertices'][mapped])
+            nodes.append(object['node_ids'][mapped])
+        np.savez(self.node_map_path, names=np.array(names, dtype=str), objects=np.concatenate(objects),
+                 vertices=np.concatenate(vertices), nodes=np.concatenate(nodes))
+
+    def import_results(self, frd_path):
+        node_map = np.load(self.node_map_path)
+        objects = [bpy.data.objects[name] for name in node_map['names'].tolist()]
+        bounds = np.searchsorted(node_map['objects'], np.arange(len(objects) + 1))
+        # CalculiX displacements are global, shape keys and attributes are local
+        world_to_local = [np.linalg.inv(np.array(object.matrix_world, dtype=np.float64)[:3, :3]) for object in objects]
+        basis = []
+        for object in objects:
+            co = np.empty(len(object.data.vertices) * 3, dtype=np.float32)
+            object.data.vertices.foreach_get('co', co)
+            basis.append(co.reshape(-1, 3))
+
+        with FrdReader(frd_path) as reader:
+            for increment, (step, increment_time, ids, values) in enumerate(reader.iterate('DISP')):
+                frame = self.results_start_frame + increment * self.results_frame_step
+                name = 'step {0} t={1:g}'.format(step, increment_time)
+                # NaN rows are nodes missing from the increment, left undisplaced
+                displacements = np.nan_to_num(reader.align(ids, values, node_map['nodes'])) * self.displacement_scale
+                for index, object in enumerate(objects):
+                    rows = slice(bounds[index], bounds[index + 1])
+                    displacement = np.zeros_like(basis[index])
+                    displacement[node_map['vertices'][rows]] = displacements[rows].dot(world_to_local[index].T)
+                    if self.results_mode == 'attributes':
+                        self.add_displacement_attribute(object, frame, displacement)
+                    else:
+                        self.add_displacement_shape_key(object, name, basis[index] + displacement, frame)
+                self.logger.info('imported {0} at frame {1}'.format(name, frame))
+
+    def add_displacement_shape_key(self, object, name, co, frame):
+        if object.data.shape_keys is None:
+            object.shape_key_add(name='Basis', from_mix=False)
+        key = object.shape_key_add(name=name, from_mix=False)
+        key.data.foreach_set('co', co.ravel())
+
+        # Each key ramps in from the previous increment's frame and out to the next
+        shape_keys = object.data.shape_keys
+        if shape_keys.animation_data is None:
+            shape_keys.animation_data_create()
+        if shape_keys.animation_data.action is None:
+            shape_keys.animation_data.action = bpy.data.actions.new(object.name + ' results')
+        fcurve = shape_keys.animation_data.action.fcurves.new('key_blocks["{0}"].value'.format(key.name))
+        fcurve.keyframe_points.add(3)
+        fcurve.keyframe_points.foreach_set('co', [
+            frame - self.results_frame_step, 0.0, frame, 1.0, frame + self.results_frame_step, 0.0])
+        fcurve.update()
+
+    def add_displacement_attribute(self, object, frame, displacement):
+        # Attribute data cannot be keyframed, so every increment gets its own
+        # attribute named after its frame, e.g. 'displacement 0012', for a
+        # node setup to pick from the current frame
+        attribute = object.data.attributes.new('displacement {0:04d}'.format(frame), 'FLOAT_VECTOR', 'POINT')
+        attribute.data.foreach_set('vector', displacement.ravel())
+
+    def detect_contact_pairs(self, fea_objects):
+        surfaces = [self.get_exterior_triangles(object) for object in fea_objects]
+        lower = np.array([nodes.min(axis=0) for nodes, _ in surfaces]) - self.contact_gap
+        upper = np.array([nodes.max(axis=0) for nodes, _ in surfaces]) + self.contact_gap
+
+        # Broadphase on object bounding boxes, then BVH overlap on the faces
+        touching = np.all((lower[:, np.newaxis] <= upper[np.newaxis]) & (lower[np.newaxis] <= upper[:, np.newaxis]), axis=2)
+        trees = {}
+        contact_pairs = []
+        for a, b in np.argwhere(np.triu(touching, 1)).tolist():
+            for index in (a, b):
+                if index not in trees:
+                    nodes, corners = surfaces[index]
+                    trees[index] = BVHTree.FromPolygons(nodes.tolist(), corners.tolist(), all_triangles=True, epsilon=self.contact_gap)
+            overlaps = np.array(trees[a].overlap(trees[b]), dtype=np.int64).reshape(-1, 2)
+            if not len(overlaps):
+                continue
+
+            overlaps = overlaps[self.is_facing(surfaces[a], surfaces[b], overlaps)]
+            if len(overlaps):
+                contact_pairs.append(self.get_contact_pair(len(contact_pairs) + 1, fea_objects[a], fea_objects[b], overlaps))
+
+        self.logger.info('contact detection: {0} contact pairs'.format(len(contact_pairs)))
+        return contact_pairs
+
+    def get_face_planes(self, surface, faces):
+        nodes, corners = surface
+        triangles = nodes[corners[faces]]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        areas = np.linalg.norm(normals, axis=1)
+        return triangles.mean(axis=1), normals / np.maximum(areas, 1e-300)[:, np.newaxis], areas / 2
+
+    def is_facing(self, surface_a, surface_b, overlaps):
+        # Overlapping faces are in contact when they face each other and are no
+        # further apart than contact_gap. Exterior faces of both objects share
+        # tetgen's orientation, so facing normals point in opposite directions
+        # while coplanar side walls meeting at an edge point the same way.
+        centres_a, normals_a, _ = self.get_face_planes(surface_a, overlaps[:, 0])
+        centres_b, normals_b, _ = self.get_face_planes(surface_b, overlaps[:, 1])
+        aligned = np.einsum('ij,ij->i', normals_a, normals_b) <= -self.contact_alignment
+        distance = np.abs(np.einsum('ij,ij->i', centres_b - centres_a, normals_a))
+        return aligned & (distance <= self.contact_gap)
+
+    def get_contact_pair(self, number, object_a, object_b, overlaps):
+        surface_names = list(self.surfaces)
+        sides = []
+        for object, faces in ((object_a, np.unique(overlaps[:, 0])), (object_b, np.unique(overlaps[:, 1]))):
+            rows, columns = object['exterior_faces']
+            _, _, areas = self.get_face_planes(self.get_exterior_triangles(object), faces)
+            sides.append({
+                'object': object,
+                'area': areas.sum(),
+                'faces': [[element_id, surface_names[column]] for element_id, column in zip(
+                    object['element_ids'][rows[faces]].tolist(), columns[faces].tolist())]
+                })
+
+        # The master side is the object flagged as master, otherwise the side
+        # with the larger contact area
+        slave, master = sorted(sides, key=lambda side: (side['object']['is_master'], side['area']))
+        return {
+            'slave': 'Sslav{0}'.format(number),
+            'master': 'Smast{0}'.format(number),
+            'slave_faces': slave['faces'],
+            'master_faces': master['faces'],
+            'description': '{0} on {1}'.format(slave['object']['object'].name, master['object']['object'].name)
+            }
+
+    def get_object_label(self, object):
+        # Names that had to be sanitized get a short hash of the original, so
+        # 'Cube.001' and 'Cube_001' keep separate fragments and sets
+        label = re.sub(r'[^\w-]', '_', object.name)
+        if label != object.name:
+            label = label + '_' + hashlib.sha1(object.name.encode('utf-8')).hexdigest()[:8]
+        return label
+
     def convert_m_to_mm(self):
         return
         self.youngs_modulus = 13990.0
@@ -236,42 +1015,186 @@ class FiniteElementMesher:
         self.stick_slope = self.youngs_modulus / 10 # Arbitrary nonsense?
         self.gravity = 9810.0
 
-        for index, node in enumerate(self.nodes):
-            self.nodes[index][1] = node[1] * 1000
-            self.nodes[index][2] = node[2] * 1000
-            self.nodes[index][3] = node[3] * 1000
+        self.nodes = self.nodes * 1000
 
     def write_inp_heading(self):
-        print('*HEADING\nGenerated FEA model, mm, kg, N, s\n', file=self.inp_file)
+        print('*HEADING\nGenerated FEA model, mm, kg, N, s, {0} elements\n'.format(self.element_type), file=self.inp_file)
 
     def write_inp_node(self):
         print('\n*NODE, NSET=Nall', file=self.inp_file)
-        for node in self.nodes:
-            print('{0}, {1}, {2}, {3}'.format(*node), file=self.inp_file)
+        if self.use_incremental_deck:
+            self.write_inp_fragments('nodes')
+        elif self.use_spill_files:
+            self.copy_spill_files([object['node_spill'] for object in self.fea_objects])
+        else:
+            self.write_inp_rows('node', self.node_row_format, np.column_stack([self.node_ids, self.nodes]))
 
     def write_inp_element(self):
-        print('\n*ELEMENT, TYPE=C3D10, ELSET=Eall', file=self.inp_file)
-        for element in self.elements:
-            print('{0}, {1}, {2}, {3}, {4}, {5}, {6}, {7}, {8}, {9}, {10}'.format(*element), file=self.inp_file)
+        print('\n*ELEMENT, TYPE={0}, ELSET=Eall'.format(self.element_type), file=self.inp_file)
+        if self.use_incremental_deck:
+            self.write_inp_fragments('elements')
+        elif self.use_spill_files:
+            self.copy_spill_files([object['element_spill'] for object in self.fea_objects])
+        else:
+            self.write_inp_rows('element', self.element_row_format, np.column_stack([self.element_ids, self.elements]))
             # I may have made a bad assumption here. This only applies to "simple" meshes
             # If this is true, good luck future Dion.
 
+    def write_inp_rows(self, section, row_format, table):
+        if len(table) <= self.inp_include_rows:
+            self.inp_file.writelines(self.format_table(row_format, table))
+            return
+
+        includes = []
+        for start in range(0, len(table), self.inp_include_rows):
+            path = '{0}fea_{1}_{2}.inp'.format(self.base_path, section, len(includes) + 1)
+            includes.append((path, table[start:start + self.inp_include_rows]))
+        with ThreadPoolExecutor(max_workers=self.tetgen_workers) as executor:
+            list(executor.map(lambda include: self.write_inp_include(include[0], row_format, include[1]), includes))
+        for path, _ in includes:
+            print('*INCLUDE, INPUT=' + os.path.basename(path), file=self.inp_file)
+
+    def write_inp_include(self, path, row_format, table):
+        with open(path, 'w', buffering=self.inp_buffer_size) as file:
+            file.writelines(self.format_table(row_format, table))
+
+    def load_deck_manifest(self):
+        try:
+            with open(self.deck_manifest_path) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('settings') != self.get_deck_settings():
+            return {}
+        return manifest['objects']
+
+    def save_deck_manifest(self, fea_objects):
+        records = {object['object'].name: object['deck_record'] for object in fea_objects}
+        labels = set(record['label'] for record in records.values())
+        for name in os.listdir(self.deck_path):
+            if name.endswith('.inp') and name.split('.')[0] not in labels:
+                os.remove(self.deck_path + name)
+        with open(self.deck_manifest_path, 'w') as file:
+            json.dump({'settings': self.get_deck_settings(), 'objects': records}, file, indent=1, sort_keys=True)
+
+    def get_deck_settings(self):
+        # Anything that changes fragment contents without changing the mesh hash
+        return {
+            'node_rounding': self.node_rounding,
+            'element_type': self.element_type,
+            'element_node_order': self.element_node_order,
+            'use_node_renumbering': self.use_node_renumbering,
+            'node_row_format': self.node_row_format,
+            'element_row_format': self.element_row_format
+            }
+
+    def get_range_capacity(self, count):
+        return int(math.ceil(count * (1 + self.deck_range_headroom)))
+
+    def allocate_deck_ranges(self, fea_objects):
+        # Objects keep their previous id ranges while their tetrahedralization
+        # still fits and no earlier object has grown into them, so editing one
+        # block leaves the fragments of the others untouched
+        previous_records = self.load_deck_manifest()
+        os.makedirs(self.deck_path, exist_ok=True)
+        node_cursor = 1
+        element_cursor = 1
+        for object in fea_objects:
+            node_count = len(object['tetgen_output']['nodes'])
+            element_count = len(object['tetgen_output']['elements'])
+            # Keyed on the raw name, labels are only used for file and set names
+            previous = previous_records.get(object['object'].name)
+
+            if (previous is not None and
+                    previous['node_start'] >= node_cursor and node_count <= previous['node_capacity'] and
+                    previous['element_start'] >= element_cursor and element_count <= previous['element_capacity']):
+                record = {key: previous[key] for key in ('node_start', 'node_capacity', 'element_start', 'element_capacity')}
+            else:
+                record = {
+                    'node_start': node_cursor,
+                    'node_capacity': self.get_range_capacity(node_count),
+                    'element_start': element_cursor,
+                    'element_capacity': self.get_range_capacity(element_count)
+                    }
+            record['label'] = self.get_object_label(object['object'])
+            record['mesh_hash'] = object['mesh_hash']
+            record['matrix_world'] = object['matrix_world'].ravel().tolist()
+            record['node_count'] = node_count
+            record['element_count'] = element_count
+
+            object['deck_record'] = record
+            object['deck_dirty'] = record != previous
+            node_cursor = record['node_start'] + record['node_capacity']
+            element_cursor = record['element_start'] + record['element_capacity']
+
+        self.logger.info('incremental deck: {0} of {1} objects changed'.format(
+            sum(object['deck_dirty'] for object in fea_objects), len(fea_objects)))
+
+    def write_inp_fragments(self, section):
+        for object in self.fea_objects:
+            path = '{0}{1}.{2}.inp'.format(self.deck_path, object['deck_record']['label'], section)
+            if object['deck_dirty'] or not os.path.exists(path):
+                if section == 'nodes':
+                    rows = object['node_rows']
+                    self.write_inp_include(path, self.node_row_format, np.column_stack([self.node_ids[rows], self.nodes[rows]]))
+                else:
+                    rows = object['element_rows']
+                    self.write_inp_include(path, self.element_row_format, np.column_stack([self.element_ids[rows], self.elements[rows]]))
+            print('*INCLUDE, INPUT=' + os.path.relpath(path, self.base_path).replace(os.sep, '/'), file=self.inp_file)
+
+    def get_node_axis_index(self):
+        # Rebuilt whenever self.nodes is replaced, e.g. by the concatenation in build_deck
+        if self.node_axis_index is None or self.node_axis_index[0] is not self.nodes:
+            order = np.argsort(self.nodes, axis=0, kind='stable').T
+            self.node_axis_index = (self.nodes, order, np.take_along_axis(self.nodes.T, order, axis=1))
+        return self.node_axis_index[1:]
+
+    def get_node_rows_in_band(self, axis, low, high):
+        order, values = self.get_node_axis_index()
+        start = np.searchsorted(values[axis], low, side='left')
+        stop = np.searchsorted(values[axis], high, side='right')
+        return order[axis, start:stop]
+
+    def select_nodes_in_band(self, axis, low, high):
+        return np.sort(self.node_ids[self.get_node_rows_in_band(axis, low, high)])
+
+    def select_nodes_by_plane(self, axis, value, tolerance = None):
+        tolerance = self.ground_tolerance if tolerance is None else tolerance
+        return self.select_nodes_in_band(axis, value - tolerance, value + tolerance)
+
+    def select_nodes_in_box(self, low, high, tolerance = 0.0):
+        low = np.asarray(low, dtype=np.float64) - tolerance
+        high = np.asarray(high, dtype=np.float64) + tolerance
+        # Search along every axis, but only filter the narrowest band on the others
+        bands = [self.get_node_rows_in_band(axis, low[axis], high[axis]) for axis in range(3)]
+        rows = min(bands, key=len)
+        nodes = self.nodes[rows]
+        rows = rows[np.all((nodes >= low) & (nodes <= high), axis=1)]
+        return np.sort(self.node_ids[rows])
+
     def detect_ground_nodes(self):
-        ground_nodes = []
-        for node in self.nodes:
-            if node[3] == 0:
-                ground_nodes.append(node[0])
-        return ground_nodes
+        if self.use_spill_files:
+            return np.concatenate([np.empty(0, dtype=np.int32)] + self.ground_nodes)
+        return self.select_nodes_by_plane(2, self.ground_height, self.ground_tolerance)
+
+    def write_inp_nset(self, name, node_ids):
+        print('\n*NSET, NSET=' + name, file=self.inp_file)
+        self.inp_file.write(',\n'.join(map(str, np.asarray(node_ids).tolist())) + '\n')
 
     def write_inp_ground_boundary(self, ground_nodes):
         if len(ground_nodes):
-            print('\n*NSET, NSET=FIX', file=self.inp_file)
-            print(',\n'.join(str(node) for node in ground_nodes), file=self.inp_file)
+            self.write_inp_nset('FIX', ground_nodes)
             print('\n*BOUNDARY', file=self.inp_file)
             print('FIX, 1', file=self.inp_file)
             print('FIX, 2', file=self.inp_file)
             print('FIX, 3', file=self.inp_file)
 
+    def write_inp_boundary_sets(self):
+        for object in self.fea_objects:
+            rows, _ = object['exterior_faces']
+            print('\n*ELSET, ELSET=B{0}'.format(self.get_object_label(object['object'])), file=self.inp_file)
+            self.inp_file.write(',\n'.join(map(str, np.unique(object['element_ids'][rows]).tolist())) + '\n')
+
     def write_inp_material(self):
         print('\n*MATERIAL, NAME=SANDSTONE', file=self.inp_file)
         print('*ELASTIC', file=self.inp_file)
@@ -281,14 +1204,16 @@ class FiniteElementMesher:
         print('*SOLID SECTION, ELSET=Eall, MATERIAL=SANDSTONE', file=self.inp_file)
 
     def write_inp_contact_pair(self):
-        print('\n*SURFACE, NAME=Sslav', file=self.inp_file)
-        for slave in self.slaves:
-            print('{0},{1}'.format(*slave), file=self.inp_file)
-        print('*SURFACE, NAME=Smast', file=self.inp_file)
-        for master in self.masters:
-            print('{0},{1}'.format(*master), file=self.inp_file)
-        print('*CONTACT PAIR, INTERACTION=SI1, TYPE=SURFACE TO SURFACE', file=self.inp_file)
-        print('Sslav, Smast', file=self.inp_file)
+        for contact_pair in self.contact_pairs:
+            print('', file=self.inp_file)
+            if 'description' in contact_pair:
+                print('** ' + contact_pair['description'], file=self.inp_file)
+            print('*SURFACE, NAME=' + contact_pair['slave'], file=self.inp_file)
+            self.inp_file.write(''.join('{0},{1}\n'.format(*slave) for slave in contact_pair['slave_faces']))
+            print('*SURFACE, NAME=' + contact_pair['master'], file=self.inp_file)
+            self.inp_file.write(''.join('{0},{1}\n'.format(*master) for master in contact_pair['master_faces']))
+            print('*CONTACT PAIR, INTERACTION=SI1, TYPE=SURFACE TO SURFACE', file=self.inp_file)
+            print(contact_pair['slave'] + ', ' + contact_pair['master'], file=self.inp_file)
         print('*SURFACE INTERACTION,NAME=SI1', file=self.inp_file)
         print('*SURFACE BEHAVIOR,PRESSURE-OVERCLOSURE=LINEAR', file=self.inp_file)
         print(self.pressure_overclosure, ',3', file=self.inp_file)
@@ -296,35 +1221,342 @@ class FiniteElementMesher:
         print(self.friction_coefficient, ',', self.stick_slope, file=self.inp_file)
 
     def write_inp_step(self):
-        print('\n*STEP,NLGEOM', file=self.inp_file)
-        print('*DYNAMIC', file=self.inp_file)
-        print('0.01,0.5', file=self.inp_file)
-        print('*DLOAD', file=self.inp_file)
-        print('Eall,GRAV,', self.gravity, ',0.,0.,-1.', file=self.inp_file)
-        print('*NODE FILE', file=self.inp_file)
-        print('U', file=self.inp_file)
-        print('*EL FILE', file=self.inp_file)
-        print('S', file=self.inp_file)
-        print('*END STEP', file=self.inp_file)
-
-
-    def load_tetgen_output(self, source, rounding = None):
-        with open(source) as file:
-            lines = [line.rstrip('\n') for line in file]
-            lines.pop(0)
-            lines.pop(-1)
-            for index, line in enumerate(lines):
-                lines[index] = line.split()
-                for index2, value in enumerate(lines[index]):
-                    if rounding:
-                        lines[index][index2] = round(float(value), rounding)
-                    else:
-                        lines[index][index2] = round(float(value))
-            return lines
+        self.inp_file.write(self.step_templates[self.step_type].format(gravity=self.gravity))
+
+    def read_tetgen_output(self, source, dtype = np.float64):
+        # Parses a tetgen .node/.ele/.face/.neigh file into a (count, columns) array.
+        # The file is memory-mapped and converted chunk by chunk with np.fromstring,
+        # so no per-line Python objects are created.
+        if os.path.getsize(source) == 0:
+            raise ValueError('Empty tetgen output: ' + source)
+
+        with open(source, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header, position = self.read_tetgen_line(data, 0)
+            count = int(header[0])
+            first_row, _ = self.read_tetgen_line(data, position)
+            columns = len(first_row) if count else 1
+            expected = count * columns
+
+            chunks = []
+            parsed = 0
+            while parsed < expected and position < len(data):
+                end = data.find(b'\n', min(position + self.tetgen_chunk_size, len(data)))
+                end = len(data) if end == -1 else end + 1
+                # A comment runs to the end of its line, so the chunk is cut at the
+                # '#' and the next one starts on the following line. tetgen only
+                # writes its '# Generated by' line after the last row.
+                stop = data.find(b'#', position, end)
+                if stop == -1:
+                    stop = end
+                else:
+                    end = data.find(b'\n', stop)
+                    end = len(data) if end == -1 else end + 1
+                if stop > position:
+                    values = np.fromstring(data[position:stop], dtype=np.float64, sep=' ')
+                    chunks.append(values)
+                    parsed = parsed + len(values)
+                position = end
+
+        if parsed < expected:
+            raise ValueError('Truncated tetgen output: {0} has {1} of {2} values'.format(source, parsed, expected))
+
+        table = np.concatenate(chunks)[:expected].reshape(count, columns) if chunks else np.empty((0, columns))
+        if np.issubdtype(dtype, np.integer):
+            return np.rint(table).astype(dtype)
+        return table.astype(dtype, copy=False)
+
+    def read_tetgen_line(self, data, position):
+        # Returns the tokens of the next non-comment line and the offset after it
+        while position < len(data):
+            end = data.find(b'\n', position)
+            end = len(data) if end == -1 else end
+            tokens = data[position:end].split(b'#', 1)[0].split()
+            position = end + 1
+            if tokens:
+                return tokens, position
+        return [], position
+
+    def read_optional_tetgen_output(self, source, dtype = np.float64):
+        if not os.path.exists(source):
+            return None
+        return self.read_tetgen_output(source, dtype)
+
+class TetgenCache:
+
+    # Parsed tetgen output stored as .npz files named by content hash, with
+    # least recently used entries evicted once max_bytes is exceeded
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def contains(self, key):
+        # Hits are counted when get loads the entry, misses here
+        if os.path.exists(self.get_entry_path(key)):
+            return True
+        self.misses = self.misses + 1
+        return False
+
+    def get_entry_path(self, key):
+        return self.path + key + '.npz'
+
+    def get(self, key):
+        path = self.get_entry_path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError):
+            self.misses = self.misses + 1
+            return None
+        os.utime(path)
+        self.hits = self.hits + 1
+        return arrays
+
+    def put(self, key, arrays):
+        path = self.get_entry_path(key)
+        # Write beside the entry and rename, so a crash never leaves half a file
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(path + '.tmp', path)
+        self.evict()
+
+    def get_entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                stat = os.stat(self.path + name)
+                entries.append((stat.st_mtime, stat.st_size, self.path + name))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.get_entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total = total - size
+
+    def get_stats(self):
+        entries = self.get_entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries)
+            }
+
+class FrdReader:
+    # Reads nodal results of a CalculiX .frd file (ASCII, the default) without
+    # loading it: the file is memory-mapped, the block headers are indexed by
+    # jumping over each fixed-width block, and only the requested block is parsed.
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.node_block = None
+        self.blocks = []
+        self.index()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_line(self, position):
+        end = self.data.find(b'\n', position)
+        end = len(self.data) if end == -1 else end + 1
+        return self.data[position:end], end
+
+    def index(self):
+        position = 0
+        while position < len(self.data):
+            line, next_position = self.read_line(position)
+            key = line[:6].strip()
+            if key == b'2C':
+                self.node_block = self.get_block(line.split()[1:], b'COORD', [b'X', b'Y', b'Z'], next_position)
+                next_position = self.node_block['end']
+            elif key == b'3C':
+                # Element connectivity is variable width, so only this block is scanned
+                end = self.data.find(b'\n -3', next_position)
+                next_position = len(self.data) if end == -1 else self.read_line(end + 1)[1]
+            elif key == b'100C':
+                next_position = self.index_result_block(line, next_position)
+            elif key == b'9999':
+                break
+            position = next_position
+
+    def index_result_block(self, header, position):
+        # '  100CL  101 0.100000000E+01     4486   ...    0    1           1' gives the
+        # time, the node count and, counted from the end, the step and the format
+        tokens = header.split()
+        name, position = self.read_line(position)
+        components = []
+        while True:
+            line, next_position = self.read_line(position)
+            if not line.startswith(b' -5'):
+                break
+            fields = line.split()
+            # Components flagged with IEXIST = 1, such as ALL, have no values in the file
+            if len(fields) < 7 or re.match(rb'\d*', fields[6]).group() in (b'', b'0'):
+                components.append(fields[1])
+            position = next_position
+        block = self.get_block([tokens[3], tokens[-1]], name.split()[1], components, position)
+        block['time'] = float(tokens[2])
+        block['step'] = int(tokens[-2])
+        self.blocks.append(block)
+        return block['end']
+
+    def get_block(self, header, name, components, start):
+        count, format = int(header[0]), int(header[-1])
+        if format not in (0, 1):
+            raise ValueError('Binary .frd results are not supported: ' + self.path)
+        id_width = 10 if format == 1 else 5
+        # Each node takes one ' -1' line of up to six values plus ' -2' continuation lines
+        line_starts = []
+        record_length = 0
+        for _ in range(max(1, -(-len(components) // 6))):
+            line_starts.append(record_length)
+            record_length = self.read_line(start + record_length)[1] - start
+        end = start + count * record_length
+        if count and self.data[end:end + 3] != b' -3':
+            raise ValueError('Unexpected .frd block layout for {0} in {1}'.format(name.decode(), self.path))
+        return {
+            'name': name.decode(),
+            'components': [component.decode() for component in components],
+            'count': count,
+            'id_width': id_width,
+            'start': start,
+            'record_length': record_length,
+            'line_starts': line_starts,
+            'end': self.read_line(end)[1] if count else start
+            }
+
+    def parse_block(self, block):
+        count, record_length, id_width = block['count'], block['record_length'], block['id_width']
+        records = np.frombuffer(self.data, dtype=np.uint8, count=count * record_length, offset=block['start']).reshape(count, record_length)
+        ids = np.ascontiguousarray(records[:, 3:3 + id_width]).view('S{0}'.format(id_width)).ravel().astype(np.int64)
+
+        columns = []
+        for line, line_start in enumerate(block['line_starts']):
+            values = min(6, len(block['components']) - 6 * line)
+            first = line_start + 3 + id_width
+            columns.append(np.ascontiguousarray(records[:, first:first + 12 * values]).view('S12'))
+        values = np.concatenate(columns, axis=1).astype(np.float64) if columns else np.empty((count, 0))
+        return ids, values
+
+    def get_increments(self):
+        return sorted(set((block['step'], block['time']) for block in self.blocks))
+
+    def get_names(self):
+        return sorted(set(block['name'] for block in self.blocks))
+
+    def read_nodes(self):
+        return self.parse_block(self.node_block)
+
+    def read(self, name, step):
+        # Returns the node ids and a (count, components) array of one increment
+        for block in self.blocks:
+            if block['name'] == name and block['step'] == step:
+                return self.parse_block(block)
+        raise KeyError('No {0} results for step {1} in {2}'.format(name, step, self.path))
+
+    def iterate(self, name):
+        for block in self.blocks:
+            if block['name'] == name:
+                ids, values = self.parse_block(block)
+                yield block['step'], block['time'], ids, values
+
+    def align(self, ids, values, node_ids):
+        # Rows of values in the order of node_ids, NaN where a node has no result
+        aligned = np.full((len(node_ids), values.shape[1]), np.nan)
+        order = np.argsort(ids)
+        rows = np.searchsorted(ids, node_ids, sorter=order).clip(0, max(len(ids) - 1, 0))
+        found = ids[order[rows]] == node_ids if len(ids) else np.zeros(len(node_ids), dtype=bool)
+        aligned[found] = values[order[rows[found]]]
+        return aligned
+
+class DatReader:
+    # Reads the tables a CalculiX .dat file prints for *NODE PRINT and *EL PRINT,
+    # one block at a time, e.g. ' stresses (elem, integ.pnt.,sxx,...) for set EALL and time  0.1E+01'
+
+    header = re.compile(r'^\s*(.+?)\s*\((.*)\)\s*for set\s+(\S+)\s+and time\s+(\S+)')
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        block = None
+        with open(self.path) as file:
+            for line in file:
+                match = self.header.match(line)
+                if match:
+                    if block is not None:
+                        yield self.get_table(block)
+                    block = {
+                        'name': match.group(1),
+                        'columns': [column.strip() for column in match.group(2).split(',')],
+                        'set': match.group(3),
+                        'time': float(match.group(4)),
+                        'rows': []
+                        }
+                elif block is not None and self.is_table_row(line):
+                    block['rows'].append(line)
+        if block is not None:
+            yield self.get_table(block)
+
+    def is_table_row(self, line):
+        # Skips the blank lines and the 'S T E P' and 'INCREMENT' banners between tables
+        fields = line.split()
+        return bool(fields) and re.match(r'-?\d', fields[0]) is not None
+
+    def get_table(self, block):
+        rows = block.pop('rows')
+        width = len(rows[0].split()) if rows else len(block['columns'])
+        block['table'] = np.fromstring(''.join(rows), dtype=np.float64, sep=' ').reshape(-1, width)
+        return block
+
+def parse_arguments(argv):
+    # Blender passes everything after '--' through to the script, e.g.
+    # blender -b fea4.blend --python fea4.py -- --output C:/runs/fea4/
+    parser = argparse.ArgumentParser(prog='fea4.py')
+    parser.add_argument('--output', help='directory for the deck, scratch files and report')
+    parser.add_argument('--tetgen', help='path to the tetgen executable')
+    parser.add_argument('--element-type', choices=['C3D10', 'C3D4'], help='element type, C3D4 for fast first-pass models')
+    parser.add_argument('--step', choices=['dynamic', 'static'], help='analysis step, static for a quick gravity check')
+    parser.add_argument('--tetgen-workers', type=int, help='concurrent tetgen processes, one per CPU by default')
+    parser.add_argument('--results', help='import displacements from this .frd instead of meshing')
+    return parser.parse_args(argv[argv.index('--') + 1:] if '--' in argv else [])
 
-print('===== STARTING EXECUTION =====')
-finite_element_mesher = FiniteElementMesher()
-finite_element_mesher.execute()
+if __name__ == '__main__':
+    print('===== STARTING EXECUTION =====')
+    arguments = parse_arguments(sys.argv)
+    options = {}
+    if arguments.output:
+        options['base_path'] = os.path.join(os.path.abspath(arguments.output), '').replace(os.sep, '/')
+        os.makedirs(options['base_path'], exist_ok=True)
+    if arguments.tetgen:
+        options['tetgen_path'] = arguments.tetgen
+    finite_element_mesher = FiniteElementMesher(**options)
+    if arguments.element_type:
+        finite_element_mesher.set_element_type(arguments.element_type)
+    if arguments.step:
+        finite_element_mesher.step_type = arguments.step
+    if arguments.tetgen_workers:
+        finite_element_mesher.tetgen_workers = arguments.tetgen_workers
+    if arguments.results:
+        finite_element_mesher.import_results(arguments.results)
+    else:
+        finite_element_mesher.execute()
 # output_file = open('output.src', 'w')
 # output_file.write(code)
 # output_file.close()
@@ -0,0 +1,131 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Meshes a batch of .blend files with fea4.py in background Blender processes:
+#   python fea_batch.py fea*.blend block_breakdown*.blend --output runs/ --workers 4
+# Every file gets its own directory under --output (deck, scratch files, tetgen
+# cache, fea_report.json and blender.log), and runs/summary.json lists them all.
+
+
+def get_blend_files(patterns):
+    # Also returns the patterns that matched nothing, so a typo fails the batch
+    blend_files = []
+    unmatched = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern] if os.path.isfile(pattern) else []
+        if not matches:
+            unmatched.append(pattern)
+        blend_files.extend(os.path.abspath(match) for match in matches if os.path.abspath(match) not in blend_files)
+    return blend_files, unmatched
+
+
+def get_output_directories(blend_files, output):
+    # One directory per file, named after it, numbered when two files share a name
+    directories = []
+    for blend_file in blend_files:
+        name = os.path.splitext(os.path.basename(blend_file))[0]
+        directory = os.path.join(output, name)
+        suffix = 1
+        while directory in directories:
+            suffix = suffix + 1
+            directory = os.path.join(output, '{0}_{1}'.format(name, suffix))
+        directories.append(directory)
+    return directories
+
+
+def run_blender(arguments, blend_file, directory):
+    os.makedirs(directory, exist_ok=True)
+    command = [arguments.blender, '-b', blend_file, '--python-exit-code', '1', '--python', arguments.script,
+               '--', '--output', directory]
+    if arguments.tetgen:
+        command.extend(['--tetgen', arguments.tetgen])
+    if arguments.element_type:
+        command.extend(['--element-type', arguments.element_type])
+    if arguments.step:
+        command.extend(['--step', arguments.step])
+    command.extend(['--tetgen-workers', str(arguments.tetgen_workers)])
+
+    result = {'blend_file': blend_file, 'output': directory}
+    started = time.perf_counter()
+    with open(os.path.join(directory, 'blender.log'), 'w') as log:
+        try:
+            result['returncode'] = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, timeout=arguments.timeout)
+        except subprocess.TimeoutExpired:
+            result['returncode'] = None
+    result['seconds'] = time.perf_counter() - started
+    result['status'] = 'ok' if result['returncode'] == 0 else 'timeout' if result['returncode'] is None else 'failed'
+
+    try:
+        with open(os.path.join(directory, 'fea_report.json')) as file:
+            report = json.load(file)
+        result['nodes'] = report['nodes']
+        result['elements'] = report['elements']
+        result['objects'] = len(report['objects'])
+    except (OSError, ValueError, KeyError):
+        if result['status'] == 'ok':
+            result['status'] = 'no report'
+
+    print('{status:<9} {seconds:8.1f}s  {blend_file}'.format(**result))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mesh .blend files with fea4.py in parallel background Blender processes')
+    parser.add_argument('blend_files', nargs='+', help='.blend files or glob patterns')
+    parser.add_argument('--output', default='fea_batch', help='directory for the per-file output directories and summary.json')
+    parser.add_argument('--blender', default='blender', help='path to the blender executable')
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fea4.py'), help='mesher script to run')
+    parser.add_argument('--tetgen', help='path to the tetgen executable, passed on to the script')
+    parser.add_argument('--element-type', choices=['C3D10', 'C3D4'], help='element type, passed on to the script')
+    parser.add_argument('--step', choices=['dynamic', 'static'], help='analysis step, passed on to the script')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help='concurrent Blender processes')
+    parser.add_argument('--tetgen-workers', type=int,
+                        help='concurrent tetgen processes per Blender process, CPUs divided by --workers by default')
+    parser.add_argument('--timeout', type=float, help='seconds before a Blender process is killed')
+    arguments = parser.parse_args()
+    if arguments.workers < 1:
+        parser.error('--workers must be at least 1')
+    if arguments.tetgen_workers is not None and arguments.tetgen_workers < 1:
+        parser.error('--tetgen-workers must be at least 1')
+    if arguments.tetgen_workers is None:
+        # Split the CPUs between the Blender processes instead of oversubscribing them
+        arguments.tetgen_workers = max(1, (os.cpu_count() or 1) // arguments.workers)
+
+    blend_files, unmatched = get_blend_files(arguments.blend_files)
+    if unmatched:
+        parser.error('no .blend files match ' + ', '.join(unmatched))
+    output = os.path.abspath(arguments.output)
+    directories = get_output_directories(blend_files, output)
+    os.makedirs(output, exist_ok=True)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=arguments.workers) as executor:
+        results = list(executor.map(lambda job: run_blender(arguments, *job), zip(blend_files, directories)))
+
+    summary = {
+        'blender': arguments.blender,
+        'script': arguments.script,
+        'workers': arguments.workers,
+        'tetgen_workers': arguments.tetgen_workers,
+        'seconds': time.perf_counter() - started,
+        'failed': sum(result['status'] != 'ok' for result in results),
+        'runs': results
+        }
+    with open(os.path.join(output, 'summary.json'), 'w') as file:
+        json.dump(summary, file, indent=1)
+    print('{0} of {1} files meshed in {2:.1f}s, summary in {3}'.format(
+        len(results) - summary['failed'], len(results), summary['seconds'], os.path.join(output, 'summary.json')))
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+# Runs the mesher's post-tetgen pipeline on synthetic tetgen output, outside
+# Blender, so branches can be compared on a plain Linux box:
+#   python fea_benchmark.py --sizes 1000 100000 --json results.json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fea_stubs import install_stub_modules
+install_stub_modules()
+import fea4
+
+# Corners of the six tetrahedra of a unit cube, as offsets into its 8 corners
+# (x + 2y + 4z), all sharing the 0-7 diagonal
+cube_tetrahedra = np.array([
+    [0, 1, 3, 7], [0, 3, 2, 7], [0, 2, 6, 7],
+    [0, 6, 4, 7], [0, 4, 5, 7], [0, 5, 1, 7]
+    ])
+# Corner pairs of CalculiX's C3D10 midside nodes 5-10
+calculix_edges = np.array([[0, 1], [1, 2], [2, 0], [0, 3], [1, 3], [2, 3]])
+
+
+def get_tetgen_edges(node_order):
+    # Midside order of tetgen's -o2 .ele rows, inverted from the mesher's
+    # C3D10 node order so the two cannot disagree
+    return calculix_edges[np.argsort(node_order)[4:] - 4]
+
+
+def get_block_mesh(element_count, node_order):
+    # A block of side cubes split into tetrahedra, numbered like tetgen -o2 output
+    tetgen_edges = get_tetgen_edges(node_order)
+    side = max(1, int(round((element_count / 6.0) ** (1.0 / 3.0))))
+    grid = np.stack(np.meshgrid(*[np.arange(side + 1)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+    corners = grid[:, 0] * (side + 1) ** 2 + grid[:, 1] * (side + 1) + grid[:, 2]
+
+    cubes = np.stack(np.meshgrid(*[np.arange(side)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = np.array([[i & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)])
+    cube_corners = (cubes[:, None] + offsets[None]).dot([(side + 1) ** 2, side + 1, 1])
+    tetrahedra = cube_corners[:, cube_tetrahedra].reshape(-1, 4)
+
+    edges = np.sort(tetrahedra[:, tetgen_edges], axis=2).reshape(-1, 2)
+    unique_edges, edge_index = np.unique(edges, axis=0, return_inverse=True)
+    nodes = np.concatenate([grid, grid[unique_edges].mean(axis=1)]).astype(np.float64) / side
+    midsides = len(corners) + edge_index.reshape(-1, 6)
+    elements = np.column_stack([tetrahedra, midsides]) + 1
+
+    # Reordered for CalculiX, every midside node sits halfway along its edge
+    calculix = elements[:, np.array(node_order) - 1] - 1
+    assert np.allclose(nodes[calculix[:, 4:]], nodes[calculix[:, calculix_edges]].mean(axis=2))
+
+    # Blender vertices are the surface corners, tagged on the top face
+    surface = np.flatnonzero(np.any((grid == 0) | (grid == side), axis=1))
+    node_vertices = np.full(len(nodes), -1, dtype=np.int32)
+    node_vertices[surface] = np.arange(len(surface), dtype=np.int32)
+    tagged = grid[surface, 2] == side
+    return nodes, elements, node_vertices, tagged
+
+
+def save_tetgen_output(mesher, base, nodes, elements):
+    with open(base + '.1.node', 'w') as file:
+        file.write('{0}  3  0  0\n'.format(len(nodes)))
+        file.writelines(mesher.format_table('%d %.17g %.17g %.17g\n', np.column_stack([np.arange(1, len(nodes) + 1), nodes])))
+        file.write('# Generated by fea_benchmark.py\n')
+    with open(base + '.1.ele', 'w') as file:
+        file.write('{0}  10  0\n'.format(len(elements)))
+        file.writelines(mesher.format_table(' '.join(['%d'] * 11) + '\n', np.column_stack([np.arange(1, len(elements) + 1), elements])))
+        file.write('# Generated by fea_benchmark.py\n')
+
+
+def load_tetgen_output(source, rounding = None):
+    # The line-by-line parser fea1-fea3 still use, kept to compare against
+    with open(source) as file:
+        lines = [line.rstrip('\n') for line in file]
+        lines.pop(0)
+        lines.pop(-1)
+        for index, line in enumerate(lines):
+            lines[index] = line.split()
+            for index2, value in enumerate(lines[index]):
+                if rounding:
+                    lines[index][index2] = round(float(value), rounding)
+                else:
+                    lines[index][index2] = round(float(value))
+        return lines
+
+
+def compare_parsers(mesher, source, repeat):
+    # Best-of-repeat wall time of the legacy parser and read_tetgen_output
+    timings = {}
+    for name, parse in (
+            ('load_tetgen_output', lambda: load_tetgen_output(source, mesher.node_rounding)),
+            ('read_tetgen_output', lambda: mesher.read_tetgen_output(source))):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parse()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+
+    legacy = np.array(load_tetgen_output(source, mesher.node_rounding), dtype=np.float64)
+    table = np.round(mesher.read_tetgen_output(source), mesher.node_rounding)
+    timings['identical'] = bool(np.array_equal(legacy, table))
+    return timings
+
+
+def get_stub_object(name, tagged):
+    vertices = [types.SimpleNamespace(groups=[0] if is_tagged else []) for is_tagged in tagged.tolist()]
+    return types.SimpleNamespace(name=name, data=types.SimpleNamespace(vertices=vertices))
+
+
+def run_stages(mesher, base, node_vertices, stub_object):
+    fea_object = {'object': stub_object}
+    with mesher.stage('parse'):
+        tetgen_output = {
+            'nodes': mesher.read_tetgen_output(base + '.1.node'),
+            'elements': mesher.read_tetgen_output(base + '.1.ele', np.int32),
+            'node_vertices': node_vertices
+            }
+    yield 'parse'
+    with mesher.stage('renumber'):
+        tetgen_output = mesher.renumber_tetgen_output(stub_object.name, tetgen_output)
+    yield 'renumber'
+    with mesher.stage('number'):
+        fea_object['node_ids'], fea_object['nodes'] = mesher.get_nodes(tetgen_output['nodes'], np.eye(4))
+        fea_object['element_ids'], fea_object['elements'] = mesher.get_elements(tetgen_output['elements'])
+        fea_object['node_vertices'] = tetgen_output['node_vertices']
+        mesher.node_ids, mesher.nodes = fea_object['node_ids'], fea_object['nodes']
+        mesher.element_ids, mesher.elements = fea_object['element_ids'], fea_object['elements']
+    yield 'number'
+    with mesher.stage('exterior_faces'):
+        fea_object['exterior_faces'] = mesher.get_exterior_faces(fea_object)
+    yield 'exterior_faces'
+    with mesher.stage('tagging'):
+        mesher.get_tagged_surfaces(fea_object)
+    yield 'tagging'
+    with mesher.stage('ground'):
+        mesher.detect_ground_nodes()
+    yield 'ground'
+    with mesher.stage('write_inp'):
+        mesher.inp_file = open(mesher.inp_path, 'w', buffering=mesher.inp_buffer_size)
+        mesher.write_inp_node()
+        mesher.write_inp_element()
+        mesher.inp_file.close()
+    yield 'write_inp'
+
+
+def benchmark(element_count, path, repeat, trace_memory, parsers):
+    mesher = fea4.FiniteElementMesher(path)
+    nodes, elements, node_vertices, tagged = get_block_mesh(element_count, mesher.element_types['C3D10']['node_order'])
+    base = path + 'block'
+    save_tetgen_output(mesher, base, nodes, elements)
+    stub_object = get_stub_object('block', tagged)
+
+    results = {}
+    for _ in range(repeat):
+        mesher = fea4.FiniteElementMesher(path)
+        mesher.tetgen_cache = None
+        if trace_memory:
+            tracemalloc.start()
+        for name in run_stages(mesher, base, node_vertices, stub_object):
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+            if trace_memory:
+                tracemalloc.reset_peak()
+            wall = mesher.stage_timings[-1]['wall']
+            if name not in results or wall < results[name]['wall']:
+                results[name] = {
+                    'wall': wall,
+                    'cpu': mesher.stage_timings[-1]['cpu'],
+                    'elements_per_second': len(elements) / wall if wall else None,
+                    'peak_memory': peak
+                    }
+        if trace_memory:
+            tracemalloc.stop()
+
+    result = {
+        'elements': len(elements),
+        'nodes': len(nodes),
+        'stages': results,
+        'peak_rss': mesher.get_peak_rss()
+        }
+    if parsers:
+        result['parsers'] = compare_parsers(mesher, base + '.1.node', repeat)
+    return result
+
+
+def print_results(result):
+    print('\n{elements} elements, {nodes} nodes'.format(**result))
+    for name, stage in result['stages'].items():
+        print('  {0:<16} {1:9.3f}s {2:14.0f} elements/s {3:>10}'.format(
+            name, stage['wall'], stage['elements_per_second'] or 0,
+            '' if stage['peak_memory'] is None else '{0:.1f} MB'.format(stage['peak_memory'] / 1024 ** 2)))
+    if 'parsers' in result:
+        parsers = result['parsers']
+        print('  .node parsing: load_tetgen_output {0:.3f}s, read_tetgen_output {1:.3f}s, {2:.1f}x faster, {3}'.format(
+            parsers['load_tetgen_output'], parsers['read_tetgen_output'],
+            parsers['load_tetgen_output'] / parsers['read_tetgen_output'], 'identical' if parsers['identical'] else 'MISMATCH'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the FEA mesher on synthetic tetgen output')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6], help='approximate element counts')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the fastest is reported')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false', help='skip tracemalloc peaks, which slow the run slightly')
+    parser.add_argument('--compare-parsers', action='store_true', help='also time the legacy line-by-line .node parser against read_tetgen_output')
+    parser.add_argument('--json', help='write the results to this file')
+    arguments = parser.parse_args()
+
+    results = []
+    for size in arguments.sizes:
+        path = tempfile.mkdtemp(prefix='fea_benchmark_') + '/'
+        try:
+            results.append(benchmark(size, path, arguments.repeat, arguments.trace_memory, arguments.compare_parsers))
+        finally:
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
+            shutil.rmtree(path, ignore_errors=True)
+        print_results(results[-1])
+
+    if arguments.json:
+        with open(arguments.json, 'w') as file:
+            json.dump(results, file, indent=1)
+
+if __name__ == '__main__':
+    main()
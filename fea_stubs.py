@@ -0,0 +1,17 @@
+import sys
+import types
+
+# Stands in for the Blender modules fea4 imports, so its Blender-free parts
+# can run on a plain Python install (fea_benchmark.py, test_fea4.py)
+
+
+def install_stub_modules():
+    # Only what fea4 touches at import time
+    for name in ('bpy', 'bmesh', 'mathutils', 'mathutils.bvhtree'):
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = types.ModuleType(name)
+    if not hasattr(sys.modules['mathutils.bvhtree'], 'BVHTree'):
+        sys.modules['mathutils.bvhtree'].BVHTree = None
+        sys.modules['mathutils'].bvhtree = sys.modules['mathutils.bvhtree']
@@ -0,0 +1,94 @@
+import os
+import types
+import shutil
+import tempfile
+import concurrent.futures
+import unittest
+import numpy as np
+
+from fea_stubs import install_stub_modules
+install_stub_modules()
+import fea4
+
+
+def get_stub_object(groups, vertex_groups):
+    vertices = [types.SimpleNamespace(groups=[types.SimpleNamespace(group=group) for group in vertex]) for vertex in groups]
+    return types.SimpleNamespace(
+        name='block',
+        data=types.SimpleNamespace(vertices=vertices),
+        vertex_groups={name: types.SimpleNamespace(index=index) for index, name in enumerate(vertex_groups)})
+
+
+class MesherTestCase(unittest.TestCase):
+    # The mesher chdirs into its base path, so each test gets a scratch one
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp(prefix='test_fea4_') + '/'
+        self.mesher = fea4.FiniteElementMesher(self.path)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class TestVertexGroupMask(MesherTestCase):
+    def test_any_group(self):
+        object = get_stub_object([[0], [], [1]], ['contact', 'other'])
+        np.testing.assert_array_equal(self.mesher.get_vertex_group_mask(object), [True, False, True])
+
+    def test_named_group(self):
+        self.mesher.contact_vertex_group = 'contact'
+        object = get_stub_object([[0], [], [1], [1, 0]], ['contact', 'other'])
+        np.testing.assert_array_equal(self.mesher.get_vertex_group_mask(object), [True, False, False, True])
+
+    def test_object_without_named_group(self):
+        self.mesher.contact_vertex_group = 'contact'
+        object = get_stub_object([[0], [], [0]], ['other'])
+        mask = self.mesher.get_vertex_group_mask(object)
+        self.assertEqual(mask.dtype, bool)
+        np.testing.assert_array_equal(mask, [False, False, False])
+
+
+class TestObjectLabel(MesherTestCase):
+    def test_sanitized_names_stay_distinct(self):
+        labels = [self.mesher.get_object_label(types.SimpleNamespace(name=name)) for name in ('Cube_001', 'Cube.001', 'Cube 001')]
+        self.assertEqual(labels[0], 'Cube_001')
+        self.assertEqual(len(set(labels)), 3)
+        for label in labels:
+            self.assertRegex(label, r'^[\w-]+$')
+
+
+class TestSpillInstances(MesherTestCase):
+    def get_tetrahedron_output(self):
+        # One C3D10 tetrahedron in tetgen -o2 numbering, midsides on edges
+        # (2,3), (0,3), (0,1), (1,2), (1,3), (2,0)
+        corners = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+        edges = [[2, 3], [0, 3], [0, 1], [1, 2], [1, 3], [2, 0]]
+        nodes = np.concatenate([corners, corners[edges].mean(axis=1)])
+        return {
+            'nodes': np.column_stack([np.arange(1, 11), nodes]),
+            'elements': np.arange(11, dtype=np.int32)[np.newaxis],
+            'node_vertices': None
+            }
+
+    def test_instances_without_renumbering(self):
+        self.mesher.use_spill_files = True
+        self.mesher.use_node_renumbering = False
+        self.mesher.tetgen_cache = None
+        self.mesher.ground_nodes = []
+        os.makedirs(self.mesher.spill_path)
+        future = concurrent.futures.Future()
+        future.set_result(self.get_tetrahedron_output())
+        source = {'instance_of': None, 'tetgen_future': future, 'vertices': None}
+        fea_objects = [source, {'instance_of': source}, {'instance_of': source}]
+        for index, object in enumerate(fea_objects):
+            object.update(object=types.SimpleNamespace(name='block'), name='block', index=index, mesh_hash='shape', matrix_world=np.eye(4))
+
+        for object in fea_objects:
+            self.mesher.process_object(object, {}, {id(source): 2})
+        self.assertEqual([object['node_ids'][0] for object in fea_objects], [1, 11, 21])
+        self.assertEqual([object['element_ids'][0] for object in fea_objects], [1, 2, 3])
+        self.assertTrue(all(object['tetgen_output'] is None for object in fea_objects))
+
+if __name__ == '__main__':
+    unittest.main()